@@ -1,15 +1,36 @@
 import os
 import sys
+import time
+import asyncio
 import logging
 import re
+import json
+import html
+import csv
+import io
+import gzip
+import shlex
+import signal
+import tempfile
+from datetime import date, datetime, timedelta, timezone
+from collections import OrderedDict, defaultdict, deque
+from itertools import takewhile
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from aiohttp import web
 import asyncpg
-from aiogram import Bot, Dispatcher, Router, F
+from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import Update, FSInputFile
+from aiogram.types import InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import SimpleEventIsolation
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 load_dotenv()
@@ -20,6 +41,68 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 WEB_SERVER_HOST = "0.0.0.0"
 WEB_SERVER_PORT = int(os.getenv("PORT", 8080))
 WEBHOOK_PATH = "/webhook"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_QUEUE_TIMEOUT = float(os.getenv("WEBHOOK_QUEUE_TIMEOUT", 5))
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", 2000))
+
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 30)) or None
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", 300))
+
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 20))
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", 200))
+BROADCAST_STALE_AFTER = float(os.getenv("BROADCAST_STALE_AFTER", 300))
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", 15))
+GLOBAL_RATE_LIMIT = float(os.getenv("GLOBAL_RATE_LIMIT", 25))
+PER_CHAT_RATE_LIMIT = float(os.getenv("PER_CHAT_RATE_LIMIT", 1))
+RETRY_AFTER_ATTEMPTS = int(os.getenv("RETRY_AFTER_ATTEMPTS", 3))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 5000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 300))
+USER_CACHE_CHANNEL = "users_changed"
+FSM_TTL = int(os.getenv("FSM_TTL", 3 * 24 * 3600))
+FSM_GC_INTERVAL = int(os.getenv("FSM_GC_INTERVAL", 3600))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 0.5))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", 10000))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", 60))
+BULK_MAX_FILE_SIZE = 20 * 1024 * 1024
+STATS_PAGE_SIZE = int(os.getenv("STATS_PAGE_SIZE", 20))
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", 30))
+ALBUM_DEBOUNCE = float(os.getenv("ALBUM_DEBOUNCE", 0.7))
+ALBUM_LATE_WINDOW = float(os.getenv("ALBUM_LATE_WINDOW", 120))
+BUGS_PAGE_SIZE = int(os.getenv("BUGS_PAGE_SIZE", 15))
+DUP_THRESHOLD = float(os.getenv("DUP_THRESHOLD", 0.35))
+DUP_LIMIT = int(os.getenv("DUP_LIMIT", 3))
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", 2000))
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", 1))
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+# Вся остановка укладывается в 30 с, которые оркестраторы обычно дают после SIGTERM:
+# SHUTDOWN_GRACE + SHUTDOWN_TIMEOUT + SHUTDOWN_CLOSE_TIMEOUT на финальный flush и закрытие пула + SERVER_SHUTDOWN_TIMEOUT
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 20))
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", 5))
+SHUTDOWN_CLOSE_TIMEOUT = 2.0
+SERVER_SHUTDOWN_TIMEOUT = 2.0
+
+def parse_rate(spec: str):
+    """'5/10' -> не больше 5 событий за 10 секунд; '0' отключает лимит"""
+    limit, _, window = spec.strip().partition('/')
+    return int(limit), float(window or 1)
+
+# Лимиты анти-флуда по имени обработчика, переопределяются через THROTTLE_RULES="start_report=3/60,...".
+# THROTTLE_ENABLED=0 выключает анти-флуд целиком, вместе со встроенными правилами
+THROTTLE_ENABLED = os.getenv("THROTTLE_ENABLED", "1") != "0"
+THROTTLE_RULES = {
+    'start_report': (3, 60),
+    'cq_edit_points': (10, 5),
+    'handle_bug_decision': (10, 5),
+}
+THROTTLE_RULES.update(
+    (name.strip(), parse_rate(rate))
+    for name, _, rate in (r.partition('=') for r in os.getenv("THROTTLE_RULES", "").split(",") if '=' in r)
+)
+THROTTLE_DEFAULT = parse_rate(os.getenv("THROTTLE_DEFAULT", "30/10"))
 
 admin_ids_str = os.getenv("MAIN_ADMIN_IDS", "")
 MAIN_ADMIN_IDS = [int(x) for x in admin_ids_str.split(",") if x.strip().isdigit()]
@@ -29,47 +112,778 @@ if not all([BOT_TOKEN, BASE_WEBHOOK_URL, DATABASE_URL]):
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
-router = Router()
 db_pool = None
+dup_search_enabled = False
+
+# Запросы горячего пути. Текст каждого постоянный, поэтому asyncpg готовит его один раз на соединение
+# и дальше берет prepared statement из своего кэша (DB_STATEMENT_CACHE_SIZE).
+
+# Текст, по которому ищутся дубли; выражение должно совпадать с индексом bugs_search_trgm_idx
+BUG_SEARCH_EXPR = "(coalesce(steps, '') || ' ' || coalesce(actual_result, ''))"
+
+SQL_GET_USER = "SELECT * FROM users WHERE user_id = $1"
+SQL_TOUCH_USER = '''
+    INSERT INTO users (user_id, username) VALUES ($1, $2)
+    ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username, is_blocked = FALSE
+    RETURNING *
+'''
+SQL_ADJUST_POINTS = '''
+    UPDATE users SET accepted_bugs = accepted_bugs + $2, rejected_bugs = rejected_bugs + $3
+    WHERE user_id = $1 RETURNING *
+'''
+SQL_SET_GROUP = "UPDATE users SET group_name = $2 WHERE user_id = $1"
+SQL_INSERT_BUG = '''
+    INSERT INTO bugs (tester_id, group_name, version, device, steps, expected, actual_result, media)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8::jsonb) RETURNING id
+'''
+SQL_DECIDE_BUG = '''
+    WITH decided AS (
+        UPDATE bugs SET status = $2, decided_at = now() WHERE id = $1 AND status = 'pending' RETURNING id, tester_id
+    ), counted AS (
+        UPDATE users SET accepted_bugs = accepted_bugs + $3, rejected_bugs = rejected_bugs + $4
+        FROM decided WHERE users.user_id = decided.tester_id
+    )
+    SELECT tester_id, array(
+        SELECT ARRAY[admin_id, message_id] FROM bug_messages WHERE bug_id = decided.id
+    ) AS copies FROM decided
+'''
+SQL_ATTACH_MEDIA = '''
+    UPDATE bugs SET media = media || $2::jsonb WHERE id = (
+        SELECT id FROM bugs WHERE tester_id = $1 AND created_at > now() - make_interval(secs => $3)
+        ORDER BY id DESC LIMIT 1
+    ) RETURNING id
+'''
+SQL_INSERT_BUG_MESSAGE = "INSERT INTO bug_messages (bug_id, admin_id, message_id) VALUES ($1, $2, $3)"
+SQL_FIND_DUPLICATES = f'''
+    SELECT id, similarity({BUG_SEARCH_EXPR}, $1) AS score FROM (
+        SELECT * FROM bugs WHERE status IN ('pending', 'accepted')
+        ORDER BY {BUG_SEARCH_EXPR} <-> $1 LIMIT $2
+    ) b WHERE similarity({BUG_SEARCH_EXPR}, $1) >= $3 ORDER BY score DESC
+'''
+SQL_FSM_GET = "SELECT state, data, version FROM fsm_states WHERE bot_id = $1 AND chat_id = $2 AND user_id = $3"
+SQL_FSM_GET_MANY = '''
+    SELECT k.bot_id, k.chat_id, k.user_id, f.state, f.data, coalesce(f.version, 0) AS version
+    FROM unnest($1::bigint[], $2::bigint[], $3::bigint[]) AS k(bot_id, chat_id, user_id)
+    LEFT JOIN fsm_states f USING (bot_id, chat_id, user_id)
+'''
+# Запись пачки ключей с проверкой версии: строка обновляется, только если ее версия та же, что мы прочитали.
+# RETURNING отдает записанные ключи, остальные — конфликты с другим процессом
+SQL_FSM_FLUSH = '''
+    INSERT INTO fsm_states AS f (bot_id, chat_id, user_id, state, data, version, updated_at)
+    SELECT k.bot_id, k.chat_id, k.user_id, k.state, k.data::jsonb, k.version + 1, now()
+    FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::text[], $5::text[], $6::int[])
+        AS k(bot_id, chat_id, user_id, state, data, version)
+    ON CONFLICT (bot_id, chat_id, user_id) DO UPDATE
+    SET state = EXCLUDED.state, data = EXCLUDED.data, version = EXCLUDED.version, updated_at = now()
+    WHERE f.version = EXCLUDED.version - 1
+    RETURNING bot_id, chat_id, user_id, version
+'''
+
+# Читающие горячие запросы с безобидными аргументами: ими warm_up_pool заполняет кэш statement'ов
+WARM_UP_QUERIES = [(SQL_GET_USER, 0), (SQL_FSM_GET, 0, 0, 0)]
+
+class Metrics:
+    """Минимальный реестр метрик в текстовом формате Prometheus"""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[self._key(name, labels)] += value
+
+    def set(self, name: str, value: float, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound: hist[0][i] += 1
+        hist[1] += value
+        hist[2] += 1
+
+    @staticmethod
+    def _labels(labels) -> str:
+        if not labels: return ""
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+    def render(self) -> str:
+        lines, typed = [], set()
+        for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+            for (name, labels), value in sorted(series.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} {kind}")
+                    typed.add(name)
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, n in zip(self.BUCKETS + ("+Inf",), buckets + [count]):
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {n}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class InstrumentedConnection:
+    """Обертка соединения asyncpg, замеряющая время запросов"""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    async def _timed(self, method: str, query: str, *args, **kwargs):
+        op = query.split(None, 1)[0].upper() if query.strip() else "?"
+        start = time.perf_counter()
+        try:
+            return await getattr(self.conn, method)(query, *args, **kwargs)
+        except Exception:
+            metrics.inc("bot_db_errors_total", op=op)
+            raise
+        finally:
+            metrics.observe("bot_db_query_seconds", time.perf_counter() - start, op=op)
+
+    async def execute(self, query, *args, **kwargs): return await self._timed('execute', query, *args, **kwargs)
+    async def executemany(self, query, *args, **kwargs): return await self._timed('executemany', query, *args, **kwargs)
+    async def fetch(self, query, *args, **kwargs): return await self._timed('fetch', query, *args, **kwargs)
+    async def fetchrow(self, query, *args, **kwargs): return await self._timed('fetchrow', query, *args, **kwargs)
+    async def fetchval(self, query, *args, **kwargs): return await self._timed('fetchval', query, *args, **kwargs)
+
+class InstrumentedPool:
+    """Обертка пула asyncpg, замеряющая ожидание свободного соединения"""
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    @asynccontextmanager
+    async def acquire(self):
+        start = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            metrics.observe("bot_db_pool_acquire_seconds", time.perf_counter() - start)
+            yield InstrumentedConnection(conn)
+
+class MetricsSession(AiohttpSession):
+    """Сессия бота, замеряющая время вызовов Bot API и считающая 429"""
+    async def make_request(self, bot, method, timeout=None):
+        name = method.__api_method__
+        start = time.perf_counter()
+        try:
+            return await super().make_request(bot, method, timeout)
+        except TelegramRetryAfter:
+            metrics.inc("bot_telegram_flood_total", method=name)
+            raise
+        except Exception as e:
+            metrics.inc("bot_telegram_errors_total", method=name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_telegram_request_seconds", time.perf_counter() - start, method=name)
+
+class PgStorage(BaseStorage):
+    """FSM-хранилище в Postgres поверх db_pool.
+
+    Записи ключей кэшируются в процессе (FSM_CACHE_SIZE, не дольше FSM_CACHE_TTL), поэтому чтение
+    состояния, которое aiogram делает на каждом апдейте, обычно не ходит в базу. Изменения копятся
+    в памяти, и flush() раз в FSM_FLUSH_INTERVAL пишет все изменившиеся ключи одним запросом.
+
+    Запись условная по версии строки. Если ключ успел изменить другой процесс, строка перечитывается,
+    поверх нее накладываются наши изменения (новое состояние и измененные ключи data), и запись
+    повторяется при следующем flush. Так изменения не теряются при любом числе процессов, но чтение
+    из кэша точное, только если апдейты одного чата приходят в один процесс (sticky-роутинг по chat_id);
+    иначе оно может отставать не дольше FSM_CACHE_TTL.
+    """
+    def __init__(self, cache_size: int, cache_ttl: float):
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.records = OrderedDict()
+        self.dirty = set()
+
+    @staticmethod
+    def _pk(key: StorageKey):
+        return key.bot_id, key.chat_id, key.user_id
+
+    def _load(self, pk, row) -> dict:
+        state = row['state'] if row else None
+        data = json.loads(row['data']) if row and row['data'] is not None else {}
+        record = {
+            'state': state, 'data': data, 'version': row['version'] if row else 0,
+            'base_state': state, 'base_data': dict(data),
+            'changes': 0, 'fresh_until': time.monotonic() + self.cache_ttl,
+        }
+        self.records[pk] = record
+        self.records.move_to_end(pk)
+        return record
+
+    async def _record(self, key: StorageKey) -> dict:
+        pk = self._pk(key)
+        record = self.records.get(pk)
+        if record is not None and (pk in self.dirty or record['fresh_until'] > time.monotonic()):
+            self.records.move_to_end(pk)
+            metrics.inc("bot_fsm_cache_total", result="hit")
+            return record
+        metrics.inc("bot_fsm_cache_total", result="miss")
+        async with db_pool.acquire() as conn:
+            row = await conn.fetchrow(SQL_FSM_GET, *pk)
+        record = self._load(pk, row)
+        self._evict()
+        return record
+
+    def _evict(self):
+        # Несохраненные записи не вытесняем, иначе потеряем изменения
+        for pk in list(self.records):
+            if len(self.records) <= self.cache_size: break
+            if pk not in self.dirty: del self.records[pk]
+
+    def _touch(self, key: StorageKey, record: dict):
+        record['changes'] += 1
+        self.dirty.add(self._pk(key))
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        record = await self._record(key)
+        record['state'] = state.state if isinstance(state, State) else state
+        self._touch(key, record)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._record(key))['state']
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        record = await self._record(key)
+        record['data'] = dict(data)
+        self._touch(key, record)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return dict((await self._record(key))['data'])
+
+    async def flush(self):
+        """Пишет все изменившиеся ключи одним запросом; при конфликте версий сливает изменения со свежей строкой"""
+        batch = []
+        for pk in list(self.dirty):
+            record = self.records[pk]
+            if record['state'] is None and not record['data'] and not record['version']:
+                # Пустой ключ, которого нет в базе (например, /start без черновика): писать нечего
+                self.dirty.discard(pk)
+                continue
+            batch.append((pk, record['changes'], record['state'], dict(record['data'])))
+        if not batch: return
+
+        async with db_pool.acquire() as conn:
+            rows = await conn.fetch(
+                SQL_FSM_FLUSH,
+                [pk[0] for pk, *_ in batch], [pk[1] for pk, *_ in batch], [pk[2] for pk, *_ in batch],
+                [state for _, _, state, _ in batch],
+                [json.dumps(data, ensure_ascii=False) for *_, data in batch],
+                [self.records[pk]['version'] for pk, *_ in batch],
+            )
+            written = {(r['bot_id'], r['chat_id'], r['user_id']): r['version'] for r in rows}
+            conflicts = [pk for pk, *_ in batch if pk not in written]
+            fresh = await conn.fetch(SQL_FSM_GET_MANY, *zip(*conflicts)) if conflicts else []
+
+        for pk, changes, state, data in batch:
+            if pk not in written: continue
+            record = self.records[pk]
+            record['version'] = written[pk]
+            record['base_state'], record['base_data'] = state, data
+            record['fresh_until'] = time.monotonic() + self.cache_ttl
+            # Пока шел запрос, обработчик мог снова изменить запись — тогда она остается грязной
+            if record['changes'] == changes: self.dirty.discard(pk)
+
+        if conflicts: metrics.inc("bot_fsm_conflicts_total", len(conflicts))
+        for row in fresh:
+            record = self.records[(row['bot_id'], row['chat_id'], row['user_id'])]
+            theirs = json.loads(row['data']) if row['data'] is not None else {}
+            data = dict(theirs)
+            for k in record['data'].keys() | record['base_data'].keys():
+                if record['data'].get(k, _MISSING) == record['base_data'].get(k, _MISSING): continue
+                if k in record['data']: data[k] = record['data'][k]
+                else: data.pop(k, None)
+            state = record['state'] if record['state'] != record['base_state'] else row['state']
+            record.update(state=state, data=data, version=row['version'], base_state=row['state'], base_data=theirs)
+
+    async def close(self) -> None:
+        # Диспетчер зовет close до on_shutdown: финальный flush делает on_shutdown после остановки очередей
+        pass
+
+class TimedEventIsolation(SimpleEventIsolation):
+    """SimpleEventIsolation, замеряющий ожидание лока ключа FSM"""
+    @asynccontextmanager
+    async def lock(self, key: StorageKey):
+        start = time.perf_counter()
+        async with super().lock(key):
+            metrics.observe("bot_fsm_lock_wait_seconds", time.perf_counter() - start)
+            yield
+
+class InstrumentedDispatcher(Dispatcher):
+    """Диспетчер, замеряющий апдейт целиком.
+
+    Middleware диспетчера стоят внутри FSM-middleware aiogram, поэтому не видят ожидание FSM-лока
+    и чтение состояния; feed_update охватывает и их.
+    """
+    async def feed_update(self, bot: Bot, update: Update, **kwargs):
+        update_type = update.event_type
+        metrics.inc("bot_updates_total", type=update_type)
+        start = time.perf_counter()
+        try:
+            return await super().feed_update(bot, update, **kwargs)
+        except Exception:
+            metrics.inc("bot_update_errors_total", type=update_type)
+            raise
+        finally:
+            metrics.observe("bot_update_seconds", time.perf_counter() - start, type=update_type)
+
+bot = Bot(token=BOT_TOKEN, session=MetricsSession())
+fsm_storage = PgStorage(FSM_CACHE_SIZE, FSM_CACHE_TTL)
+dp = InstrumentedDispatcher(storage=fsm_storage, events_isolation=TimedEventIsolation())
+router = Router()
+broadcast_queue = asyncio.Queue()
+background_tasks = set()
+
+# Версионированные миграции схемы. Новые добавляются только в конец списка.
+# Миграции с optional=True (расширения, которых может не быть на хостинге) при ошибке пропускаются
+# и повторяются при следующем запуске.
+MIGRATIONS = [
+    (1, False, '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            role TEXT DEFAULT 'none',
+            group_name TEXT DEFAULT 'Не выбрана',
+            accepted_bugs INTEGER DEFAULT 0,
+            rejected_bugs INTEGER DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS bugs (
+            id SERIAL PRIMARY KEY,
+            tester_id BIGINT,
+            actual_result TEXT,
+            status TEXT DEFAULT 'pending'
+        );
+    '''),
+    (2, False, '''
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN DEFAULT FALSE;
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            admin_id BIGINT,
+            from_chat_id BIGINT,
+            message_id BIGINT,
+            status TEXT DEFAULT 'queued',
+            total INTEGER DEFAULT 0,
+            delivered INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            skipped INTEGER DEFAULT 0,
+            created_at TIMESTAMPTZ DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        );
+    '''),
+    (3, False, '''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            bot_id BIGINT,
+            chat_id BIGINT,
+            user_id BIGINT,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMPTZ DEFAULT now(),
+            PRIMARY KEY (bot_id, chat_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS fsm_states_updated_idx ON fsm_states (updated_at);
+    '''),
+    (4, False, '''
+        CREATE INDEX IF NOT EXISTS users_leaderboard_idx ON users (accepted_bugs DESC, user_id) WHERE role = 'tester';
+    '''),
+    (5, False, '''
+        CREATE TABLE IF NOT EXISTS bug_messages (
+            bug_id INTEGER,
+            admin_id BIGINT,
+            message_id BIGINT,
+            PRIMARY KEY (bug_id, admin_id)
+        );
+    '''),
+    (6, False, '''
+        ALTER TABLE bugs ADD COLUMN IF NOT EXISTS media JSONB NOT NULL DEFAULT '[]';
+    '''),
+    (7, False, '''
+        ALTER TABLE bugs ADD COLUMN IF NOT EXISTS group_name TEXT;
+        ALTER TABLE bugs ADD COLUMN IF NOT EXISTS version TEXT;
+        ALTER TABLE bugs ADD COLUMN IF NOT EXISTS device TEXT;
+        ALTER TABLE bugs ADD COLUMN IF NOT EXISTS steps TEXT;
+        ALTER TABLE bugs ADD COLUMN IF NOT EXISTS expected TEXT;
+        ALTER TABLE bugs ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ DEFAULT now();
+        ALTER TABLE bugs ADD COLUMN IF NOT EXISTS decided_at TIMESTAMPTZ;
+        CREATE INDEX IF NOT EXISTS bugs_active_idx ON bugs (status, id DESC) WHERE status IN ('pending', 'accepted');
+        CREATE INDEX IF NOT EXISTS bugs_tester_idx ON bugs (tester_id);
+    '''),
+    (8, True, f'''
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS bugs_search_trgm_idx ON bugs USING gist ({BUG_SEARCH_EXPR} gist_trgm_ops)
+        WHERE status IN ('pending', 'accepted');
+    '''),
+    (9, False, '''
+        ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS last_user_id BIGINT NOT NULL DEFAULT 0;
+        ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMPTZ;
+    '''),
+    (10, False, '''
+        ALTER TABLE fsm_states ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0;
+    '''),
+    (11, False, f'''
+        -- Любая запись в users рассылает id измененных строк, чтобы все инстансы сбросили их из кэша.
+        -- Payload NOTIFY ограничен 8000 байт, поэтому на больших пачках шлем '*' — сбросить кэш целиком
+        CREATE OR REPLACE FUNCTION notify_users_changed() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE ids TEXT;
+        BEGIN
+            SELECT CASE WHEN count(*) > 500 THEN '*' ELSE string_agg(user_id::text, ',') END INTO ids FROM changed;
+            IF ids IS NOT NULL THEN PERFORM pg_notify('{USER_CACHE_CHANNEL}', ids); END IF;
+            RETURN NULL;
+        END $$;
+        DROP TRIGGER IF EXISTS users_changed_insert ON users;
+        DROP TRIGGER IF EXISTS users_changed_update ON users;
+        DROP TRIGGER IF EXISTS users_changed_delete ON users;
+        CREATE TRIGGER users_changed_insert AFTER INSERT ON users REFERENCING NEW TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_users_changed();
+        CREATE TRIGGER users_changed_update AFTER UPDATE ON users REFERENCING NEW TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_users_changed();
+        CREATE TRIGGER users_changed_delete AFTER DELETE ON users REFERENCING OLD TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_users_changed();
+    '''),
+]
+MIGRATION_LOCK_ID = 0x6275677362  # общий advisory-лок, чтобы воркеры не мигрировали одновременно
+
+async def run_migrations(conn):
+    async with conn.transaction():
+        # Лок берется до любого DDL: параллельный CREATE TABLE IF NOT EXISTS на пустой базе падает на pg_type
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
+        await conn.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, applied_at TIMESTAMPTZ DEFAULT now())")
+        applied = {r['version'] for r in await conn.fetch("SELECT version FROM schema_migrations")}
+        for version, optional, sql in MIGRATIONS:
+            if version in applied: continue
+            try:
+                async with conn.transaction():
+                    await conn.execute(sql)
+                    await conn.execute("INSERT INTO schema_migrations (version) VALUES ($1)", version)
+                logging.info("Applied migration %s", version)
+            except asyncpg.PostgresError as e:
+                if not optional: raise
+                logging.warning("Optional migration %s skipped: %s", version, e)
 
 async def init_db():
-    global db_pool
-    db_pool = await asyncpg.create_pool(DATABASE_URL)
+    global db_pool, dup_search_enabled
+    db_pool = InstrumentedPool(await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+    ))
+    # Миграции идут на отдельном соединении без command_timeout: и ожидание advisory-лока,
+    # и построение индекса на большой таблице легко длятся дольше DB_COMMAND_TIMEOUT
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        await run_migrations(conn)
+    finally:
+        await conn.close()
     async with db_pool.acquire() as conn:
+        dup_search_enabled = await conn.fetchval("SELECT to_regclass('bugs_search_trgm_idx') IS NOT NULL")
+        if not dup_search_enabled:
+            logging.warning("pg_trgm index is missing, duplicate detection disabled")
         await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                role TEXT DEFAULT 'none',
-                group_name TEXT DEFAULT 'Не выбрана',
-                accepted_bugs INTEGER DEFAULT 0,
-                rejected_bugs INTEGER DEFAULT 0
-            );
-            CREATE TABLE IF NOT EXISTS bugs (
-                id SERIAL PRIMARY KEY,
-                tester_id BIGINT,
-                actual_result TEXT,
-                status TEXT DEFAULT 'pending'
-            );
-        ''')
-        for admin_id in MAIN_ADMIN_IDS:
-            await conn.execute('''
-                INSERT INTO users (user_id, role) VALUES ($1, $2)
-                ON CONFLICT (user_id) DO UPDATE SET role = EXCLUDED.role
-            ''', admin_id, 'admin')
+            INSERT INTO users (user_id, role) SELECT unnest($1::bigint[]), 'admin'
+            ON CONFLICT (user_id) DO UPDATE SET role = EXCLUDED.role WHERE users.role IS DISTINCT FROM 'admin'
+        ''', MAIN_ADMIN_IDS)
+
+async def warm_up_pool():
+    """Занимает сразу min_size соединений и выполняет на каждом WARM_UP_QUERIES,
+    чтобы первые апдейты после деплоя не ждали ни подключения, ни подготовки запросов"""
+    async def warm():
+        async with db_pool.acquire() as conn:
+            for query, *args in WARM_UP_QUERIES:
+                await conn.fetch(query, *args)
+
+    await asyncio.gather(*(warm() for _ in range(DB_POOL_MIN_SIZE)))
+
+class TokenBucket:
+    """Простой token bucket: rate токенов в секунду, не больше capacity в запасе"""
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Не выдавать токены ближайшие seconds секунд (например, после 429 с retry_after)"""
+        self.tokens = 0
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.updated:
+                    await asyncio.sleep(self.updated - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+global_limiter = TokenBucket(GLOBAL_RATE_LIMIT)
+chat_limiters = {}
+
+def get_chat_limiter(chat_id: int) -> TokenBucket:
+    limiter = chat_limiters.get(chat_id)
+    if limiter is None:
+        if len(chat_limiters) > 10000:
+            cutoff = time.monotonic() - 60
+            for cid in [c for c, l in chat_limiters.items() if l.updated < cutoff]:
+                del chat_limiters[cid]
+        limiter = chat_limiters[chat_id] = TokenBucket(PER_CHAT_RATE_LIMIT, 1)
+    return limiter
+
+async def tg_send(chat_id: int, call):
+    """Вызывает call() с учетом глобального и per-chat лимитов, повторяя при 429"""
+    for attempt in range(RETRY_AFTER_ATTEMPTS + 1):
+        await get_chat_limiter(chat_id).acquire()
+        await global_limiter.acquire()
+        try:
+            return await call()
+        except TelegramRetryAfter as e:
+            # Пауза общая: остальные отправки тоже ждут retry_after, а не продолжают упираться в лимит
+            global_limiter.pause(e.retry_after)
+            if attempt == RETRY_AFTER_ATTEMPTS: raise
+            logging.warning("Flood limit for chat %s, retry after %ss", chat_id, e.retry_after)
+
+_MISSING = object()
+
+class UserCache:
+    """TTL/LRU-кэш строк users. Любой код, который пишет в users, обязан вызвать invalidate.
+
+    Кэш свой у каждого процесса, и invalidate сбрасывает только локальную копию. Остальные инстансы
+    узнают об изменении через NOTIFY из триггера на users (см. user_cache_listener) с задержкой
+    в доли секунды. Пока слушатель переподключается, роль или блокировка могут устареть на срок
+    до USER_CACHE_TTL; после переподключения кэш сбрасывается целиком.
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int):
+        entry = self.data.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return _MISSING
+        self.data.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, user_id: int, row):
+        self.data[user_id] = (time.monotonic() + self.ttl, row)
+        self.data.move_to_end(user_id)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def invalidate(self, *user_ids: int):
+        for uid in user_ids:
+            self.data.pop(uid, None)
+
+    def clear(self):
+        self.data.clear()
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+class AlbumMiddleware(BaseMiddleware):
+    """Собирает media group в один апдейт.
+
+    Части альбома только складываются в буфер, а после паузы ALBUM_DEBOUNCE первый апдейт
+    заново проходит через диспетчер с data['album']. Так обработчик вызывается один раз
+    и не держит FSM-лок чата, пока дожидается остальных частей.
+
+    Буфер живет в памяти процесса, поэтому при нескольких инстансах все апдейты одного чата
+    должны попадать в один инстанс (sticky-маршрутизация по chat_id). Сообщения чата, пришедшие
+    во время сборки альбома, откладываются и обрабатываются после него, чтобы не обогнать альбом.
+    Части, которые опоздали и уже никем не обрабатываются, дописываются к последнему багу тестера.
+    """
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.albums = {}
+        self.chats = {}
+        self.tasks = set()
+        lifecycle.drainers.append(self.drain)
+
+    async def __call__(self, handler, event, data):
+        message = event.message
+        if not message or 'album' in data:
+            return await handler(event, data)
+        if not message.media_group_id:
+            pending = self.chats.get(message.chat.id)
+            if pending is None:
+                return await handler(event, data)
+            pending['followers'].append(event)
+            return
+
+        album = self.albums.get(message.media_group_id)
+        if album is not None:
+            album['messages'].append(message)
+            album['last'] = time.monotonic()
+            return
+        album = {'update': event, 'messages': [message], 'last': time.monotonic(), 'followers': []}
+        self.albums[message.media_group_id] = album
+        self.chats.setdefault(message.chat.id, album)
+        task = start_background(self._release(message.media_group_id, data['bot']))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def drain(self):
+        """При остановке дожидается уже начатых альбомов, а не отменяет их вместе с фоновыми задачами"""
+        while self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+    async def _release(self, group_id: str, bot: Bot):
+        album = self.albums[group_id]
+        while (delay := album['last'] + self.latency - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        del self.albums[group_id]
+        messages = sorted(album['messages'], key=lambda m: m.message_id)
+        chat_id = messages[0].chat.id
+        try:
+            result = await dp.feed_update(bot, album['update'], album=messages)
+            if result is UNHANDLED: await self._attach_late(messages)
+        except Exception:
+            logging.exception("Failed to process album %s", group_id)
+        finally:
+            # Отложенные сообщения идут по порядку; пока они обрабатываются, новые встают в ту же очередь
+            try:
+                while album['followers']:
+                    update = album['followers'].pop(0)
+                    try:
+                        await dp.feed_update(bot, update, album=None)
+                    except Exception:
+                        logging.exception("Failed to process update %s", update.update_id)
+            finally:
+                if self.chats.get(chat_id) is album:
+                    del self.chats[chat_id]
+
+    async def _attach_late(self, messages: list):
+        """Альбом, пришедший после отправки репорта (например, остаток частей), дописывается к свежему багу"""
+        user_id, media = messages[0].from_user.id, extract_media(messages)
+        if not media: return
+        async with db_pool.acquire() as conn:
+            bug_id = await conn.fetchval(SQL_ATTACH_MEDIA, user_id, json.dumps(media), ALBUM_LATE_WINDOW)
+        if bug_id is None:
+            logging.warning("Dropped %s late album parts from %s: no recent bug", len(media), user_id)
+            return
+        logging.info("Attached %s late album parts to bug #%s", len(media), bug_id)
+
+        async def notify(admin_id: int):
+            try:
+                await tg_send(admin_id, lambda: bot.send_message(admin_id, f"📎 Дополнительные вложения к багу #{bug_id}"))
+                await send_bug_media(admin_id, media)
+            except Exception as e:
+                logging.warning("Failed to send late media of bug #%s to %s: %s", bug_id, admin_id, e)
+
+        await asyncio.gather(*(notify(a) for a in MAIN_ADMIN_IDS))
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Анти-флуд: скользящее окно на пару (пользователь, обработчик).
+
+    Вешается внутренним middleware, поэтому срабатывает до обращения обработчика к БД и Bot API.
+    Лишние сообщения молча отбрасываются, на лишние нажатия кнопок отвечаем answer() без запросов к БД.
+    """
+    def __init__(self, rules: dict, default):
+        self.rules = rules
+        self.default = default
+        self.max_window = max(window for _, window in [default, *rules.values()])
+        self.hits = {}
+
+    async def __call__(self, handler, event, data):
+        name = data['handler'].callback.__name__
+        limit, window = self.rules.get(name, self.default)
+        user = data.get('event_from_user')
+        if not user or limit <= 0:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        hits = self.hits.get((user.id, name))
+        if hits is None:
+            if len(self.hits) > 10000: self._cleanup(now)
+            hits = self.hits[(user.id, name)] = deque()
+        while hits and hits[0] <= now - window:
+            hits.popleft()
+        if len(hits) >= limit:
+            metrics.inc("bot_throttled_total", handler=name)
+            if isinstance(event, CallbackQuery):
+                try: await event.answer("⏳ Слишком часто, подождите немного.")
+                except Exception: pass
+            return
+        hits.append(now)
+        return await handler(event, data)
+
+    def _cleanup(self, now: float):
+        for key in [k for k, h in self.hits.items() if not h or h[-1] <= now - self.max_window]:
+            del self.hits[key]
+
+def extract_media(messages: list) -> list:
+    media = []
+    for m in messages:
+        if m.photo: item = {'type': 'photo', 'file_id': m.photo[-1].file_id}
+        elif m.video: item = {'type': 'video', 'file_id': m.video.file_id}
+        elif m.document: item = {'type': 'document', 'file_id': m.document.file_id}
+        elif m.audio: item = {'type': 'audio', 'file_id': m.audio.file_id}
+        elif m.animation: item = {'type': 'animation', 'file_id': m.animation.file_id}
+        elif m.voice: item = {'type': 'voice', 'file_id': m.voice.file_id}
+        elif m.video_note: item = {'type': 'video_note', 'file_id': m.video_note.file_id}
+        else: continue
+        # Подпись хранится с разметкой, как ее сохранил бы copy_to
+        if m.caption: item['caption'] = m.html_text
+        media.append(item)
+    return media
+
+def media_caption(item: dict) -> dict:
+    return {'caption': item['caption'], 'parse_mode': "HTML"} if item.get('caption') else {}
+
+INPUT_MEDIA = {'photo': InputMediaPhoto, 'video': InputMediaVideo, 'document': InputMediaDocument, 'audio': InputMediaAudio}
+
+async def send_bug_media(chat_id: int, media: list):
+    """Переотправляет сохраненные file_id вместе с подписями, без повторной загрузки файлов"""
+    if len(media) == 1:
+        item = media[0]
+        send = getattr(bot, f"send_{item['type']}")
+        return await tg_send(chat_id, lambda: send(chat_id, item['file_id'], **media_caption(item)))
+    group = [INPUT_MEDIA[m['type']](media=m['file_id'], **media_caption(m)) for m in media if m['type'] in INPUT_MEDIA]
+    for i in range(0, len(group), 10):
+        await tg_send(chat_id, lambda: bot.send_media_group(chat_id, group[i:i + 10]))
 
 async def get_user(user_id: int):
-    async with db_pool.acquire() as conn:
-        return await conn.fetchrow('SELECT * FROM users WHERE user_id = $1', user_id)
+    user = user_cache.get(user_id)
+    if user is _MISSING:
+        async with db_pool.acquire() as conn:
+            user = await conn.fetchrow(SQL_GET_USER, user_id)
+        user_cache.set(user_id, user)
+    return user
 
 async def update_user_info(user_id: int, username: str):
+    cached = user_cache.get(user_id)
+    if cached is not _MISSING and cached and cached['username'] == username and not cached['is_blocked']:
+        return
     async with db_pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO users (user_id, username) VALUES ($1, $2)
-            ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username
-        ''', user_id, username)
+        user = await conn.fetchrow(SQL_TOUCH_USER, user_id, username)
+    user_cache.set(user_id, user)
 
 def get_user_mention(user_id: int, username: str) -> str:
     return f"@{username}" if username else f"<a href='tg://user?id={user_id}'>{user_id}</a>"
@@ -103,7 +917,8 @@ tester_manage_kb = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="🗑 Удалить (списком)", callback_data="admin_del_testers")]
 ])
 
-groups_kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="Beta A"), KeyboardButton(text="Beta B")]], resize_keyboard=True)
+GROUPS = ["Beta A", "Beta B"]
+groups_kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=g) for g in GROUPS]], resize_keyboard=True)
 skip_kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="Пропустить")]], resize_keyboard=True)
 skip_media_kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="Без медиа")]], resize_keyboard=True)
 
@@ -111,6 +926,21 @@ async def ping_handler(request):
     """Отвечает UptimeRobot, чтобы бот не засыпал"""
     return web.Response(text="Bot is running OK", status=200)
 
+async def ready_handler(request):
+    """Готовность для балансировщика: 200 только после старта и до начала остановки"""
+    if not lifecycle.ready: return web.Response(text="Not ready", status=503)
+    return web.Response(text="Ready", status=200)
+
+async def metrics_handler(request):
+    metrics.set("bot_user_cache_hits", user_cache.hits)
+    metrics.set("bot_user_cache_misses", user_cache.misses)
+    metrics.set("bot_user_cache_size", len(user_cache.data))
+    metrics.set("bot_broadcast_queue_size", broadcast_queue.qsize())
+    if db_pool:
+        metrics.set("bot_db_pool_size", db_pool.get_size())
+        metrics.set("bot_db_pool_idle", db_pool.get_idle_size())
+    return web.Response(body=metrics.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
 @router.message(Command("start", "admin", "my_id"))
 async def cmd_start(message: Message, state: FSMContext):
     await state.clear()
@@ -128,6 +958,18 @@ async def cmd_start(message: Message, state: FSMContext):
     else:
         await message.answer("⛔️ <b>Доступ закрыт.</b>\nПередайте этот ID администратору: <code>{}</code>".format(message.from_user.id), parse_mode="HTML")
 
+@router.message(Command("cache_stats"))
+async def cmd_cache_stats(message: Message):
+    user = await get_user(message.from_user.id)
+    if not user or user['role'] != 'admin': return
+    total = user_cache.hits + user_cache.misses
+    ratio = user_cache.hits / total * 100 if total else 0
+    await message.answer(
+        f"🗄 <b>Кэш пользователей</b>\nЗаписей: {len(user_cache.data)}\n"
+        f"Попаданий: {user_cache.hits} | Промахов: {user_cache.misses} ({ratio:.1f}%)",
+        parse_mode="HTML"
+    )
+
 @router.message(F.text == "👥 Управление тестерами")
 async def btn_manage_testers(message: Message):
     user = await get_user(message.from_user.id)
@@ -137,37 +979,117 @@ async def btn_manage_testers(message: Message):
 @router.callback_query(F.data.in_(["admin_add_testers", "admin_del_testers"]))
 async def cq_manage_testers(call: CallbackQuery, state: FSMContext):
     if call.data == "admin_add_testers":
-        await call.message.edit_text("Отправьте мне список ID тестеров (через пробел или с новой строки):")
+        await call.message.edit_text("Отправьте мне список ID тестеров (через пробел или с новой строки) или файл .txt/.csv (один ID на строку, в .csv — первая колонка):")
         await state.set_state(AdminState.waiting_for_add_users)
     else:
-        await call.message.edit_text("Отправьте мне список ID тестеров для удаления:")
+        await call.message.edit_text("Отправьте мне список ID тестеров для удаления (текстом или файлом .txt/.csv, один ID на строку):")
         await state.set_state(AdminState.waiting_for_del_users)
 
+ID_RE = re.compile(r'[0-9]{1,19}')
+ID_SEP_RE = re.compile(r'[\s,;]+')
+CSV_SEP_RE = re.compile(r'[,;\t]')
+
+def parse_id(token: str):
+    token = token.strip().strip('"').strip()
+    return int(token) if ID_RE.fullmatch(token) and int(token) < 2 ** 63 else None
+
+async def read_ids_from_document(document, csv_mode: bool):
+    """Читает ID из .txt/.csv потоком, не держа весь файл в памяти.
+
+    Одна строка — один ID, в .csv берется только первая колонка. Возвращает (ids, число отброшенных строк).
+    """
+    file = await bot.get_file(document.file_id)
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    ids, rejected, first = set(), 0, True
+
+    def feed(raw: bytes):
+        nonlocal rejected, first
+        line = raw.decode('utf-8', 'replace').lstrip('\ufeff')
+        if not line.strip(): return
+        uid = parse_id(CSV_SEP_RE.split(line, 1)[0] if csv_mode else line)
+        # Нечисловая первая строка .csv — заголовок, ошибкой не считается
+        if uid is not None: ids.add(uid)
+        elif not (csv_mode and first): rejected += 1
+        first = False
+
+    tail = b''
+    async for chunk in bot.session.stream_content(url=url, chunk_size=65536, raise_for_status=True):
+        # Строку на границе чанков дочитываем вместе со следующим
+        *lines, tail = (tail + chunk).split(b'\n')
+        for raw in lines: feed(raw)
+    feed(tail)
+    return ids, rejected
+
+async def collect_ids(message: Message):
+    """ID из текста (через пробел, запятую или с новой строки) или из файла: (ids, число отброшенных значений)"""
+    if message.document:
+        name = (message.document.file_name or '').lower()
+        if not name.endswith(('.txt', '.csv')) or (message.document.file_size or 0) > BULK_MAX_FILE_SIZE:
+            return set(), 0
+        return await read_ids_from_document(message.document, name.endswith('.csv'))
+    tokens = [t for t in ID_SEP_RE.split(message.text or '') if t]
+    ids = {uid for uid in map(parse_id, tokens) if uid is not None}
+    return ids, sum(parse_id(t) is None for t in tokens)
+
+def rejected_note(rejected: int) -> str:
+    return f"\n⚠️ Не распознано и пропущено: {rejected}" if rejected else ""
+
 @router.message(AdminState.waiting_for_add_users)
 async def process_bulk_add(message: Message, state: FSMContext):
-    ids = [int(x) for x in re.findall(r'\d+', message.text)]
-    if not ids: return await message.answer("ID не найдены. Попробуйте снова.")
-    
+    ids, rejected = await collect_ids(message)
+    if not ids: return await message.answer("ID не найдены. Попробуйте снова." + rejected_note(rejected))
+    ids = list(ids)
+
     async with db_pool.acquire() as conn:
-        for uid in ids:
-            await conn.execute('''
-                INSERT INTO users (user_id, role) VALUES ($1, $2)
+        res = await conn.fetchrow('''
+            WITH ids AS (SELECT unnest($1::bigint[]) AS user_id),
+            prev AS (SELECT u.user_id, u.role FROM users u JOIN ids USING (user_id)),
+            upsert AS (
+                INSERT INTO users (user_id, role) SELECT user_id, 'tester' FROM ids
                 ON CONFLICT (user_id) DO UPDATE SET role = EXCLUDED.role
-            ''', uid, 'tester')
-            
-    await message.answer(f"✅ Тихо добавлено {len(ids)} тестеров.", reply_markup=admin_kb)
+                WHERE users.role IS DISTINCT FROM 'tester' AND users.role IS DISTINCT FROM 'admin'
+            )
+            SELECT
+                (SELECT count(*) FROM ids) - (SELECT count(*) FROM prev) AS inserted,
+                (SELECT count(*) FROM prev WHERE role IS DISTINCT FROM 'tester' AND role IS DISTINCT FROM 'admin') AS promoted,
+                (SELECT count(*) FROM prev WHERE role = 'tester') AS already,
+                (SELECT count(*) FROM prev WHERE role = 'admin') AS admins
+        ''', ids)
+    user_cache.invalidate(*ids)
+
+    await message.answer(
+        f"✅ Обработано {len(ids)} ID.\nНовых: {res['inserted']} | Повышено до тестера: {res['promoted']} | Уже тестеры: {res['already']}"
+        f" | Админы (без изменений): {res['admins']}" + rejected_note(rejected),
+        reply_markup=admin_kb
+    )
     await state.clear()
 
 @router.message(AdminState.waiting_for_del_users)
 async def process_bulk_del(message: Message, state: FSMContext):
-    ids = [int(x) for x in re.findall(r'\d+', message.text)]
-    if not ids: return await message.answer("ID не найдены.")
-    
+    ids, rejected = await collect_ids(message)
+    if not ids: return await message.answer("ID не найдены." + rejected_note(rejected))
+    ids = list(ids)
+
     async with db_pool.acquire() as conn:
-        await conn.execute("UPDATE users SET role = 'none' WHERE user_id = ANY($1)", ids)
+        res = await conn.fetchrow('''
+            WITH ids AS (SELECT unnest($1::bigint[]) AS user_id),
+            prev AS (SELECT u.user_id, u.role FROM users u JOIN ids USING (user_id)),
+            demoted AS (
+                UPDATE users SET role = 'none' FROM ids
+                WHERE users.user_id = ids.user_id AND users.role = 'tester'
+            )
+            SELECT
+                (SELECT count(*) FROM prev WHERE role = 'tester') AS removed,
+                (SELECT count(*) FROM prev WHERE role IS DISTINCT FROM 'tester') AS not_tester,
+                (SELECT count(*) FROM ids) - (SELECT count(*) FROM prev) AS unknown
+        ''', ids)
+    user_cache.invalidate(*ids)
 
-        
-    await message.answer(f"🗑 Тихо удалено {len(ids)} тестеров.", reply_markup=admin_kb)
+    await message.answer(
+        f"🗑 Обработано {len(ids)} ID.\nУдалено: {res['removed']} | Не тестеры: {res['not_tester']} | Нет в БД: {res['unknown']}"
+        + rejected_note(rejected),
+        reply_markup=admin_kb
+    )
     await state.clear()
 
 @router.message(F.text == "📢 Рассылка")
@@ -177,37 +1099,228 @@ async def btn_broadcast(message: Message, state: FSMContext):
         await message.answer("📦 Пришлите пост (текст, фото, файл) для рассылки всем тестерам.")
         await state.set_state(AdminState.waiting_for_broadcast)
 
+def broadcast_status_text(bc) -> str:
+    return (
+        f"📢 <b>Рассылка #{bc['id']}</b> — {bc['status']}\n"
+        f"Всего: {bc['total']} | ✅ {bc['delivered']} | ❌ {bc['failed']} | ⏭ {bc['skipped']}"
+    )
+
+def broadcast_status_kb(bc_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔄 Обновить", callback_data=f"bc:{bc_id}")]])
+
+async def run_broadcast(bc_id: int):
+    """Рассылает пост тестерам по возрастанию user_id чанками по BROADCAST_CHUNK.
+
+    После каждого чанка в broadcasts сохраняются счетчики и курсор last_user_id, поэтому прерванная
+    рассылка после рестарта продолжается с места остановки, а не начинается заново.
+    """
+    async with db_pool.acquire() as conn:
+        bc = await conn.fetchrow('''
+            UPDATE broadcasts SET status = 'running', heartbeat_at = now(),
+                total = CASE WHEN last_user_id = 0 THEN (SELECT count(*) FROM users WHERE role = 'tester') ELSE total END
+            WHERE id = $1 AND status = 'queued' RETURNING *
+        ''', bc_id)
+    if not bc: return
+    cursor = bc['last_user_id']
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def deliver(uid: int, results: dict):
+        async with sem:
+            try:
+                await tg_send(uid, lambda: bot.copy_message(uid, bc['from_chat_id'], bc['message_id']))
+                results[uid] = 'delivered'
+            except TelegramForbiddenError:
+                results[uid] = 'blocked'
+            except Exception as e:
+                logging.warning("Broadcast #%s to %s failed: %s", bc_id, uid, e)
+                results[uid] = 'failed'
+
+    while True:
+        async with db_pool.acquire() as conn:
+            testers = await conn.fetch(
+                "SELECT user_id, is_blocked FROM users WHERE role = 'tester' AND user_id > $1 ORDER BY user_id LIMIT $2",
+                cursor, BROADCAST_CHUNK
+            )
+        if not testers: break
+
+        results = {}
+        try:
+            await asyncio.gather(*(deliver(t['user_id'], results) for t in testers if not t['is_blocked']))
+        finally:
+            # При отмене сохраняем только непрерывный обработанный префикс чанка: остаток дошлется после рестарта
+            done = list(takewhile(lambda t: t['is_blocked'] or t['user_id'] in results, testers))
+            if done:
+                cursor = done[-1]['user_id']
+                outcomes = [results.get(t['user_id'], 'skipped') for t in done]
+                blocked = [t['user_id'] for t, r in zip(done, outcomes) if r == 'blocked']
+                async with db_pool.acquire() as conn:
+                    if blocked:
+                        await conn.execute("UPDATE users SET is_blocked = TRUE WHERE user_id = ANY($1)", blocked)
+                        user_cache.invalidate(*blocked)
+                    await conn.execute(
+                        "UPDATE broadcasts SET delivered = delivered + $2, failed = failed + $3, skipped = skipped + $4, "
+                        "last_user_id = $5, heartbeat_at = now() WHERE id = $1",
+                        bc_id, outcomes.count('delivered'), outcomes.count('blocked') + outcomes.count('failed'),
+                        outcomes.count('skipped'), cursor
+                    )
+
+    async with db_pool.acquire() as conn:
+        bc = await conn.fetchrow("UPDATE broadcasts SET status = 'done', finished_at = now() WHERE id = $1 RETURNING *", bc_id)
+    try: await bot.send_message(bc['admin_id'], broadcast_status_text(bc), parse_mode="HTML")
+    except Exception as e: logging.warning("Broadcast #%s report failed: %s", bc_id, e)
+
+async def pending_broadcasts() -> list:
+    """Возвращает в очередь зависшие running-рассылки и отдает id всех queued"""
+    async with db_pool.acquire() as conn:
+        # Рассылки упавшего инстанса остаются в running без обновлений курсора
+        stale = await conn.fetch('''
+            UPDATE broadcasts SET status = 'queued'
+            WHERE status = 'running' AND coalesce(heartbeat_at, created_at) < now() - make_interval(secs => $1)
+            RETURNING id
+        ''', BROADCAST_STALE_AFTER)
+        for r in stale: logging.warning("Broadcast #%s was left running, resuming it", r['id'])
+        return [r['id'] for r in await conn.fetch("SELECT id FROM broadcasts WHERE status = 'queued' ORDER BY id")]
+
+async def broadcast_worker():
+    while True:
+        try:
+            bc_id = await asyncio.wait_for(broadcast_queue.get(), BROADCAST_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            # Очередь пуста: подбираем рассылки, которые вернул в queued останавливающийся инстанс
+            # или бросил упавший. Захват в run_broadcast атомарный, так что опрос из нескольких инстансов безопасен
+            if lifecycle.stopping: continue
+            try:
+                for bc_id in await pending_broadcasts(): broadcast_queue.put_nowait(bc_id)
+            except Exception:
+                logging.exception("Broadcast poll failed")
+            continue
+        try:
+            await run_broadcast(bc_id)
+        except asyncio.CancelledError:
+            # Остановка не дождалась конца рассылки: курсор сохранен, ее продолжит любой живой инстанс
+            async with db_pool.acquire() as conn:
+                await conn.execute("UPDATE broadcasts SET status = 'queued' WHERE id = $1 AND status = 'running'", bc_id)
+            raise
+        except Exception:
+            logging.exception("Broadcast #%s crashed", bc_id)
+            async with db_pool.acquire() as conn:
+                await conn.execute("UPDATE broadcasts SET status = 'error', finished_at = now() WHERE id = $1", bc_id)
+        finally:
+            broadcast_queue.task_done()
+
 @router.message(AdminState.waiting_for_broadcast)
 async def process_broadcast(message: Message, state: FSMContext):
     async with db_pool.acquire() as conn:
-        testers = await conn.fetch("SELECT user_id FROM users WHERE role = 'tester'")
-    
-    count = 0
-    for t in testers:
-        try:
-            await message.copy_to(t['user_id'])
-            count += 1
-        except Exception: pass
-            
-    await message.answer(f"✅ Обновление разослано! Доставлено: {count} тестерам.", reply_markup=admin_kb)
+        bc = await conn.fetchrow(
+            "INSERT INTO broadcasts (admin_id, from_chat_id, message_id) VALUES ($1, $2, $3) RETURNING *",
+            message.from_user.id, message.chat.id, message.message_id
+        )
+    broadcast_queue.put_nowait(bc['id'])
+
+    await message.answer("✅ Рассылка поставлена в очередь.", reply_markup=admin_kb)
+    await message.answer(broadcast_status_text(bc), reply_markup=broadcast_status_kb(bc['id']), parse_mode="HTML")
     await state.clear()
 
+@router.callback_query(F.data.startswith("bc:"))
+async def cq_broadcast_status(call: CallbackQuery):
+    bc_id = int(call.data.split(":")[1])
+    async with db_pool.acquire() as conn:
+        bc = await conn.fetchrow("SELECT * FROM broadcasts WHERE id = $1", bc_id)
+    if not bc: return await call.answer("Рассылка не найдена.")
+
+    try: await call.message.edit_text(broadcast_status_text(bc), reply_markup=broadcast_status_kb(bc_id), parse_mode="HTML")
+    except Exception: pass
+    await call.answer()
+
+STATS_COLUMNS = "user_id, username, group_name, accepted_bugs, rejected_bugs"
+STATS_FILTER = "role = 'tester' AND ($1::text IS NULL OR group_name = $1)"
+stats_cache = {}
+
+async def render_stats_page(group_idx: int, direction: str, page: int, acc: int, uid: int):
+    """Страница рейтинга по keyset-курсору (acc, uid): f — первая, n — после курсора, p — перед ним.
+
+    Условие на accepted_bugs продублировано отдельным диапазоном: иначе Postgres не сможет начать
+    скан users_leaderboard_idx с курсора и будет отфильтровывать все предыдущие страницы.
+    """
+    cache_key = (group_idx, direction, page, acc, uid)
+    cached = stats_cache.get(cache_key)
+    if cached and cached[0] > time.monotonic(): return cached[1], cached[2]
+
+    group = GROUPS[group_idx] if group_idx >= 0 else None
+    async with db_pool.acquire() as conn:
+        totals = await conn.fetchrow(
+            f"SELECT count(*) AS testers, coalesce(sum(accepted_bugs), 0) AS accepted, "
+            f"coalesce(sum(rejected_bugs), 0) AS rejected FROM users WHERE {STATS_FILTER}", group
+        )
+        if direction == 'p':
+            rows = await conn.fetch(
+                f"SELECT {STATS_COLUMNS} FROM users WHERE {STATS_FILTER} "
+                "AND accepted_bugs >= $2 AND (accepted_bugs > $2 OR user_id < $3) "
+                "ORDER BY accepted_bugs ASC, user_id DESC LIMIT $4", group, acc, uid, STATS_PAGE_SIZE
+            )
+            rows, has_next = rows[::-1], True
+        else:
+            if direction == 'n':
+                rows = await conn.fetch(
+                    f"SELECT {STATS_COLUMNS} FROM users WHERE {STATS_FILTER} "
+                    "AND accepted_bugs <= $2 AND (accepted_bugs < $2 OR user_id > $3) "
+                    "ORDER BY accepted_bugs DESC, user_id LIMIT $4", group, acc, uid, STATS_PAGE_SIZE + 1
+                )
+            else:
+                rows = await conn.fetch(
+                    f"SELECT {STATS_COLUMNS} FROM users WHERE {STATS_FILTER} "
+                    "ORDER BY accepted_bugs DESC, user_id LIMIT $2", group, STATS_PAGE_SIZE + 1
+                )
+            has_next = len(rows) > STATS_PAGE_SIZE
+            rows = rows[:STATS_PAGE_SIZE]
+
+    lines = [
+        f"📊 <b>Статистика тестеров</b> [{group or 'Все группы'}]",
+        f"Тестеров: {totals['testers']} | ✅ {totals['accepted']} | ❌ {totals['rejected']}",
+        "",
+    ]
+    start = (page - 1) * STATS_PAGE_SIZE
+    for i, u in enumerate(rows, start + 1):
+        mention = get_user_mention(u['user_id'], u['username'])
+        lines.append(f"{i}. 👤 {mention} [{u['group_name']}] | ✅ {u['accepted_bugs']} | ❌ {u['rejected_bugs']}")
+    if not rows: lines.append("Нет данных о тестерах.")
+    text = "\n".join(lines)
+
+    nav = []
+    if rows and page > 1:
+        first = rows[0]
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"st:{group_idx}:p:{page - 1}:{first['accepted_bugs']}:{first['user_id']}"))
+    if rows and has_next:
+        last = rows[-1]
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"st:{group_idx}:n:{page + 1}:{last['accepted_bugs']}:{last['user_id']}"))
+    filters = [InlineKeyboardButton(text="Все", callback_data="st:-1:f:1:0:0")]
+    filters += [InlineKeyboardButton(text=g, callback_data=f"st:{i}:f:1:0:0") for i, g in enumerate(GROUPS)]
+    kb = InlineKeyboardMarkup(inline_keyboard=[nav, filters] if nav else [filters])
+
+    if len(stats_cache) > 500:
+        now = time.monotonic()
+        for k in [k for k, v in stats_cache.items() if v[0] < now]: del stats_cache[k]
+    stats_cache[cache_key] = (time.monotonic() + STATS_CACHE_TTL, text, kb)
+    return text, kb
+
 @router.message(F.text == "📊 Статистика")
 async def btn_stats(message: Message):
     user = await get_user(message.from_user.id)
     if not user or user['role'] != 'admin': return
-    
-    async with db_pool.acquire() as conn:
-        users = await conn.fetch("SELECT user_id, username, group_name, accepted_bugs, rejected_bugs FROM users WHERE role = 'tester' ORDER BY accepted_bugs DESC")
-    
-    if not users: return await message.answer("Нет данных о тестерах.")
-        
-    text = "📊 <b>Статистика тестеров:</b>\n\n"
-    for u in users:
-        mention = get_user_mention(u['user_id'], u['username'])
-        text += f"👤 {mention} [{u['group_name']}] | ✅ {u['accepted_bugs']} | ❌ {u['rejected_bugs']}\n"
-    
-    await message.answer(text, parse_mode="HTML")
+
+    text, kb = await render_stats_page(-1, 'f', 1, 0, 0)
+    await message.answer(text, reply_markup=kb, parse_mode="HTML")
+
+@router.callback_query(F.data.startswith("st:"))
+async def cq_stats_page(call: CallbackQuery):
+    user = await get_user(call.from_user.id)
+    if not user or user['role'] != 'admin': return await call.answer()
+
+    _, group_idx, direction, page, acc, uid = call.data.split(":")
+    text, kb = await render_stats_page(int(group_idx), direction, int(page), int(acc), int(uid))
+    try: await call.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    except Exception: pass
+    await call.answer()
 
 @router.message(F.text == "🏆 Баллы")
 async def btn_points(message: Message, state: FSMContext):
@@ -241,12 +1354,13 @@ async def cq_edit_points(call: CallbackQuery):
     _, type_, action_, uid = call.data.split("_")
     uid = int(uid)
     
-    col = "accepted_bugs" if type_ == "acc" else "rejected_bugs"
-    op = "+ 1" if action_ == "add" else "- 1"
+    delta = 1 if action_ == "add" else -1
+    acc, rej = (delta, 0) if type_ == "acc" else (0, delta)
     
     async with db_pool.acquire() as conn:
-        await conn.execute(f"UPDATE users SET {col} = {col} {op} WHERE user_id = $1", uid)
-        target = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", uid)
+        target = await conn.fetchrow(SQL_ADJUST_POINTS, uid, acc, rej)
+    if not target: return await call.answer("Пользователь не найден в БД.")
+    user_cache.set(uid, target)
         
     mention = get_user_mention(target['user_id'], target['username'])
     kb = call.message.reply_markup
@@ -263,10 +1377,11 @@ async def start_report(message: Message, state: FSMContext):
 
 @router.message(BugReport.choosing_group)
 async def process_group(message: Message, state: FSMContext):
-    if message.text not in ["Beta A", "Beta B"]: return
+    if message.text not in GROUPS: return
     
     async with db_pool.acquire() as conn:
-        await conn.execute("UPDATE users SET group_name = $1 WHERE user_id = $2", message.text, message.from_user.id)
+        await conn.execute(SQL_SET_GROUP, message.from_user.id, message.text)
+    user_cache.invalidate(message.from_user.id)
         
     await state.update_data(group=message.text)
     await message.answer("<b>Шаг 1 из 6:</b> Укажите версию (билд):", reply_markup=ReplyKeyboardRemove(), parse_mode="HTML")
@@ -303,16 +1418,37 @@ async def process_actual(message: Message, state: FSMContext):
     await message.answer("<b>Шаг 6 из 6:</b> Прикрепите медиа (или нажмите кнопку):", reply_markup=skip_media_kb, parse_mode="HTML")
     await state.set_state(BugReport.waiting_for_media)
 
+def bug_report_text(bug_id: int, mention: str, bug) -> str:
+    return (
+        f"🚨 <b>БАГ #{bug_id}</b>\n\n"
+        f"👤 <b>От:</b> {mention}\n"
+        f"🏷 <b>Группа:</b> {bug['group_name']}\n"
+        f"📱 <b>Устройство:</b> {bug['device']}\n"
+        f"<b>1. Версия:</b> {bug['version']}\n"
+        f"<b>2. Шаги:</b>\n{bug['steps']}\n"
+        f"<b>3. Ожидалось:</b>\n{bug['expected']}\n"
+        f"<b>4. Факт:</b>\n{bug['actual_result']}"
+    )
+
+async def find_duplicates(conn, steps: str, actual: str) -> list:
+    """Ближайшие открытые баги по триграммам (KNN по GiST-индексу)"""
+    if not dup_search_enabled: return []
+    query = f"{steps or ''} {actual or ''}"
+    return await conn.fetch(SQL_FIND_DUPLICATES, query, DUP_LIMIT, DUP_THRESHOLD)
+
 @router.message(BugReport.waiting_for_media)
-async def process_media(message: Message, state: FSMContext):
+async def process_media(message: Message, state: FSMContext, album: list = None):
     data = await state.get_data()
     user_db = await get_user(message.from_user.id)
-    
+    media = extract_media(album or [message])
+    # Сообщение без поддерживаемых вложений (например, текст) пересылается как есть
+    extra = message if not media and message.text != "Без медиа" else None
+
     async with db_pool.acquire() as conn:
-        bug_id = await conn.fetchval(
-            'INSERT INTO bugs (tester_id, actual_result) VALUES ($1, $2) RETURNING id',
-            message.from_user.id, data.get('actual')
-        )
+        # Поиск до вставки, чтобы новый баг не нашел сам себя
+        duplicates = await find_duplicates(conn, data.get('steps'), data.get('actual'))
+        bug_id = await conn.fetchval(SQL_INSERT_BUG, message.from_user.id, data.get('group'), data.get('version'), data.get('device'),
+            data.get('steps'), data.get('expected'), data.get('actual'), json.dumps(media))
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Принять", callback_data=f"bug:accept:{bug_id}:{message.from_user.id}")],
@@ -321,62 +1457,274 @@ async def process_media(message: Message, state: FSMContext):
     ])
 
     mention = get_user_mention(user_db['user_id'], user_db['username'])
-    report_text = (
-        f"🚨 <b>БАГ #{bug_id}</b>\n\n"
-        f"👤 <b>От:</b> {mention}\n"
-        f"🏷 <b>Группа:</b> {data.get('group')}\n"
-        f"📱 <b>Устройство:</b> {data.get('device')}\n"
-        f"<b>1. Версия:</b> {data.get('version')}\n"
-        f"<b>2. Шаги:</b>\n{data.get('steps')}\n"
-        f"<b>3. Ожидалось:</b>\n{data.get('expected')}\n"
-        f"<b>4. Факт:</b>\n{data.get('actual')}"
-    )
+    report_text = bug_report_text(bug_id, mention, {
+        'group_name': data.get('group'), 'device': data.get('device'), 'version': data.get('version'),
+        'steps': data.get('steps'), 'expected': data.get('expected'), 'actual_result': data.get('actual'),
+    })
+    if duplicates:
+        report_text += "\n\n🔍 <b>Похожие баги:</b> " + ", ".join(f"#{d['id']} ({d['score']:.2f})" for d in duplicates)
 
-    for admin_id in MAIN_ADMIN_IDS:
+    async def notify(admin_id: int):
         try:
-            await bot.send_message(admin_id, report_text, parse_mode="HTML", reply_markup=kb)
-            if message.text != "Без медиа":
-                await message.copy_to(admin_id)
-        except Exception: pass
-            
+            msg = await tg_send(admin_id, lambda: bot.send_message(admin_id, report_text, parse_mode="HTML", reply_markup=kb))
+            # Копию записываем сразу: если другой админ решит баг, пока идет рассылка медиа, она тоже обновится
+            async with db_pool.acquire() as conn:
+                await conn.execute(SQL_INSERT_BUG_MESSAGE, bug_id, admin_id, msg.message_id)
+            if media: await send_bug_media(admin_id, media)
+            elif extra: await tg_send(admin_id, lambda: extra.copy_to(admin_id))
+        except Exception as e:
+            logging.warning("Failed to notify admin %s about bug #%s: %s", admin_id, bug_id, e)
+
+    await asyncio.gather(*(notify(a) for a in MAIN_ADMIN_IDS))
+
     await message.answer("✅ Баг отправлен. Ожидайте ответа разработчика.", reply_markup=ReplyKeyboardRemove())
     await state.clear()
 
 @router.callback_query(F.data.startswith("bug:"))
 async def handle_bug_decision(call: CallbackQuery):
-    _, action, bug_id, tester_id = call.data.split(":")
-    bug_id, tester_id = int(bug_id), int(tester_id)
-    
+    _, action, bug_id, _ = call.data.split(":")
+    bug_id = int(bug_id)
+
+    if action == "accept":
+        status, acc, rej = 'accepted', 1, 0
+        msg_to_tester, status_text = f"✅ Ваш баг-репорт #{bug_id} принят!", "✅ <b>Принят</b>"
+    elif action in ["dup", "notbug"]:
+        status, acc, rej = 'rejected', 0, 1
+        reason = "Уже было" if action == "dup" else "Не является багом"
+        msg_to_tester, status_text = f"❌ Баг-репорт #{bug_id} отклонен ({reason}).", f"❌ <b>Отклонен ({reason})</b>"
+    else:
+        return await call.answer()
+
+    # Статус и счетчики меняются одним запросом и только для pending: повторные нажатия ничего не делают
     async with db_pool.acquire() as conn:
-        if action == "accept":
-            await conn.execute("UPDATE bugs SET status = 'accepted' WHERE id = $1", bug_id)
-            await conn.execute("UPDATE users SET accepted_bugs = accepted_bugs + 1 WHERE user_id = $1", tester_id)
-            msg_to_tester, status_text = f"✅ Ваш баг-репорт #{bug_id} принят!", "✅ <b>Принят</b>"
-        elif action in ["dup", "notbug"]:
-            await conn.execute("UPDATE bugs SET status = 'rejected' WHERE id = $1", bug_id)
-            await conn.execute("UPDATE users SET rejected_bugs = rejected_bugs + 1 WHERE user_id = $1", tester_id)
-            reason = "Уже было" if action == "dup" else "Не является багом"
-            msg_to_tester, status_text = f"❌ Баг-репорт #{bug_id} отклонен ({reason}).", f"❌ <b>Отклонен ({reason})</b>"
+        decided = await conn.fetchrow(SQL_DECIDE_BUG, bug_id, status, acc, rej)
+    if decided is None:
+        return await call.answer("Решение по этому багу уже принято.")
+    tester_id = decided['tester_id']
+    user_cache.invalidate(tester_id)
+    await call.answer()
 
     try: await bot.send_message(tester_id, msg_to_tester)
     except Exception: pass
-        
-    new_text = call.message.html_text + f"\n\n<i>Статус: {status_text}</i>"
-    await call.message.edit_text(new_text, parse_mode="HTML", reply_markup=None)
+
+    decided_by = get_user_mention(call.from_user.id, call.from_user.username)
+    new_text = call.message.html_text + f"\n\n<i>Статус: {status_text} ({decided_by})</i>"
+    targets = {(call.message.chat.id, call.message.message_id)}
+    targets.update((admin_id, message_id) for admin_id, message_id in decided['copies'])
+
+    async def edit_copy(chat_id: int, message_id: int):
+        try:
+            await tg_send(chat_id, lambda: bot.edit_message_text(
+                new_text, chat_id=chat_id, message_id=message_id, parse_mode="HTML", reply_markup=None
+            ))
+        except Exception as e:
+            logging.warning("Failed to update bug #%s copy for %s: %s", bug_id, chat_id, e)
+
+    await asyncio.gather(*(edit_copy(chat_id, message_id) for chat_id, message_id in targets))
+
+BUGS_COLUMNS = "id, version, group_name, left(actual_result, 50) AS preview"
+BUGS_FILTER = "status = 'accepted' AND ($1::text IS NULL OR group_name = $1) AND ($2::text IS NULL OR version = $2)"
+
+def bugs_callback(group_idx: int, direction: str, cursor: int, version: str) -> str:
+    return f"ab:{group_idx}:{direction}:{cursor}:{version}"
+
+def version_fits_callback(version: str) -> bool:
+    """Версия попадает в фильтр, только если влезает в 64 байта callback_data самой длинной кнопки —
+    навигации с максимальным id бага"""
+    return len(bugs_callback(-1, 'n', 2 ** 31 - 1, version).encode()) <= 64
+
+async def render_active_bugs(group_idx: int, version: str, direction: str, cursor: int):
+    """Страница активных багов по id: f — первая, n — старше курсора, p — новее"""
+    group = GROUPS[group_idx] if group_idx >= 0 else None
+    version = version or None
+    async with db_pool.acquire() as conn:
+        versions = await conn.fetch(
+            "SELECT version, count(*) AS cnt FROM bugs WHERE status = 'accepted' "
+            "AND ($1::text IS NULL OR group_name = $1) GROUP BY version ORDER BY cnt DESC, version LIMIT 10", group
+        )
+        if direction == 'p':
+            rows = await conn.fetch(
+                f"SELECT {BUGS_COLUMNS} FROM bugs WHERE {BUGS_FILTER} AND id > $3 ORDER BY id LIMIT $4",
+                group, version, cursor, BUGS_PAGE_SIZE + 1
+            )
+            has_prev, has_next = len(rows) > BUGS_PAGE_SIZE, True
+            rows = rows[:BUGS_PAGE_SIZE][::-1]
+        else:
+            if direction == 'n':
+                rows = await conn.fetch(
+                    f"SELECT {BUGS_COLUMNS} FROM bugs WHERE {BUGS_FILTER} AND id < $3 ORDER BY id DESC LIMIT $4",
+                    group, version, cursor, BUGS_PAGE_SIZE + 1
+                )
+            else:
+                rows = await conn.fetch(
+                    f"SELECT {BUGS_COLUMNS} FROM bugs WHERE {BUGS_FILTER} ORDER BY id DESC LIMIT $3",
+                    group, version, BUGS_PAGE_SIZE + 1
+                )
+            has_prev, has_next = direction == 'n', len(rows) > BUGS_PAGE_SIZE
+            rows = rows[:BUGS_PAGE_SIZE]
+
+    lines = [f"📝 <b>Активные баги</b> [{group or 'Все группы'}{', ' + html.escape(version) if version else ''}]"]
+    lines.append(" | ".join(f"{html.escape(v['version'] or '—')}: {v['cnt']}" for v in versions) or "🎉 Нет активных принятых багов.")
+    lines.append("")
+    for b in rows:
+        lines.append(f"▪️ <b>#{b['id']}</b> [{html.escape(b['version'] or '—')}]: {html.escape(b['preview'] or '')}...")
+    text = "\n".join(lines)
+
+    v = version or ''
+    nav = []
+    if rows and has_prev:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=bugs_callback(group_idx, 'p', rows[0]['id'], v)))
+    if rows and has_next:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=bugs_callback(group_idx, 'n', rows[-1]['id'], v)))
+    groups = [InlineKeyboardButton(text="Все", callback_data=bugs_callback(-1, 'f', 0, v))]
+    groups += [InlineKeyboardButton(text=g, callback_data=bugs_callback(i, 'f', 0, v)) for i, g in enumerate(GROUPS)]
+    version_btns = [InlineKeyboardButton(text="Все версии", callback_data=bugs_callback(group_idx, 'f', 0, ''))]
+    version_btns += [
+        InlineKeyboardButton(text=r['version'], callback_data=bugs_callback(group_idx, 'f', 0, r['version']))
+        for r in versions[:5] if r['version'] and version_fits_callback(r['version'])
+    ]
+    kb = [row for row in (nav, groups, version_btns[:3], version_btns[3:]) if row]
+    return text, InlineKeyboardMarkup(inline_keyboard=kb)
 
 @router.message(F.text == "🐛 Активные баги")
 async def btn_active_bugs(message: Message):
     user = await get_user(message.from_user.id)
     if not user or user['role'] != 'admin': return
-    
+
+    text, kb = await render_active_bugs(-1, '', 'f', 0)
+    await message.answer(text, reply_markup=kb, parse_mode="HTML")
+
+@router.callback_query(F.data.startswith("ab:"))
+async def cq_active_bugs_page(call: CallbackQuery):
+    user = await get_user(call.from_user.id)
+    if not user or user['role'] != 'admin': return await call.answer()
+
+    _, group_idx, direction, cursor, version = call.data.split(":", 4)
+    text, kb = await render_active_bugs(int(group_idx), version, direction, int(cursor))
+    try: await call.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    except Exception: pass
+    await call.answer()
+
+@router.message(Command("bug"))
+async def cmd_bug(message: Message):
+    user = await get_user(message.from_user.id)
+    if not user or user['role'] != 'admin': return
+
+    arg = (message.text or '').partition(' ')[2].strip()
+    if not arg.isdigit(): return await message.answer("Использование: /bug &lt;ID&gt;", parse_mode="HTML")
     async with db_pool.acquire() as conn:
-        bugs = await conn.fetch("SELECT id, actual_result FROM bugs WHERE status = 'accepted'")
-        
-    if not bugs: return await message.answer("🎉 Нет активных принятых багов.")
-        
-    text = "📝 <b>Список активных багов:</b>\n\n"
-    for b in bugs: text += f"▪️ <b>#{b['id']}</b>: {b['actual_result'][:50]}...\n"
-    await message.answer(text, parse_mode="HTML")
+        bug = await conn.fetchrow("SELECT b.*, u.username FROM bugs b LEFT JOIN users u ON u.user_id = b.tester_id WHERE b.id = $1", int(arg))
+    if not bug: return await message.answer("Баг не найден.")
+
+    text = bug_report_text(bug['id'], get_user_mention(bug['tester_id'], bug['username']), bug)
+    await message.answer(text + f"\n\n<i>Статус: {bug['status']}</i>", parse_mode="HTML")
+    media = json.loads(bug['media'])
+    if media: await send_bug_media(message.chat.id, media)
+
+# Запрос и фильтры, которые он принимает (в порядке параметров)
+EXPORT_QUERIES = {
+    'bugs': ('''
+        SELECT id, tester_id, status, group_name, version, device, steps, expected, actual_result, created_at, decided_at
+        FROM bugs
+        WHERE ($1::text IS NULL OR status = $1) AND ($2::text IS NULL OR group_name = $2)
+          AND ($3::timestamptz IS NULL OR created_at >= $3) AND ($4::timestamptz IS NULL OR created_at < $4)
+        ORDER BY id
+    ''', ('status', 'group', 'from', 'to')),
+    'testers': ('''
+        SELECT user_id, username, group_name, accepted_bugs, rejected_bugs
+        FROM users WHERE role = 'tester' AND ($1::text IS NULL OR group_name = $1)
+        ORDER BY accepted_bugs DESC, user_id
+    ''', ('group',)),
+}
+EXPORT_USAGE = (
+    "Использование: <code>/export bugs|testers [csv|jsonl] [plain] [status=accepted] "
+    "[group=\"Beta A\"] [from=2024-01-01] [to=2024-01-31]</code>\n"
+    "Файл сжимается gzip, <code>plain</code> отключает сжатие. Для testers доступен только фильтр group."
+)
+
+def parse_export_args(text: str):
+    args = shlex.split(text)[1:]
+    if not args or args[0] not in EXPORT_QUERIES: raise ValueError
+    opts = {'kind': args[0], 'fmt': 'csv', 'gz': True, 'status': None, 'group': None, 'from': None, 'to': None}
+    for arg in args[1:]:
+        key, _, value = arg.partition('=')
+        if key in ('csv', 'jsonl') and not value: opts['fmt'] = key
+        elif key in ('gz', 'plain') and not value: opts['gz'] = key == 'gz'
+        elif key in ('status', 'group') and value: opts[key] = value
+        elif key in ('from', 'to') and value:
+            day = datetime.combine(date.fromisoformat(value), datetime.min.time(), timezone.utc)
+            opts[key] = day + timedelta(days=1) if key == 'to' else day
+        else: raise ValueError
+    filters = EXPORT_QUERIES[opts['kind']][1]
+    if any(opts[k] is not None for k in ('status', 'group', 'from', 'to') if k not in filters): raise ValueError
+    return opts
+
+export_slots = asyncio.Semaphore(EXPORT_CONCURRENCY)
+
+async def run_export(chat_id: int, opts: dict):
+    """Пишет выгрузку во временный файл пачками по EXPORT_CHUNK строк через серверный курсор.
+
+    Одновременно идет не больше EXPORT_CONCURRENCY выгрузок: каждая держит соединение пула до конца.
+    Файл больше лимита Telegram на загрузку ботом не дописывается, вместо него приходит подсказка.
+    """
+    async with export_slots:
+        await _run_export(chat_id, opts)
+
+async def _run_export(chat_id: int, opts: dict):
+    suffix = f".{opts['fmt']}" + (".gz" if opts['gz'] else "")
+    fd, path = tempfile.mkstemp(prefix=f"export_{opts['kind']}_", suffix=suffix)
+    os.close(fd)
+    rows_total, too_large = 0, False
+    try:
+        f = gzip.open(path, 'wt', encoding='utf-8', newline='') if opts['gz'] else open(path, 'w', encoding='utf-8', newline='')
+        with f:
+            async with db_pool.acquire() as conn:
+                async with conn.transaction():
+                    query, filters = EXPORT_QUERIES[opts['kind']]
+                    cursor = await conn.cursor(query, *(opts[k] for k in filters))
+                    header_written = False
+                    while rows := await cursor.fetch(EXPORT_CHUNK):
+                        buf = io.StringIO()
+                        if opts['fmt'] == 'csv':
+                            writer = csv.writer(buf)
+                            if not header_written:
+                                writer.writerow(rows[0].keys())
+                                header_written = True
+                            writer.writerows(tuple(r.values()) for r in rows)
+                        else:
+                            for r in rows:
+                                buf.write(json.dumps(dict(r), ensure_ascii=False, default=str) + "\n")
+                        await asyncio.to_thread(f.write, buf.getvalue())
+                        rows_total += len(rows)
+                        if too_large := os.path.getsize(path) > TELEGRAM_UPLOAD_LIMIT: break
+
+        if too_large or os.path.getsize(path) > TELEGRAM_UPLOAD_LIMIT:
+            limit_mb = TELEGRAM_UPLOAD_LIMIT // (1024 * 1024)
+            hint = "сузьте фильтры status/group/from/to" + ("" if opts['gz'] else " или уберите plain")
+            return await bot.send_message(chat_id, f"❌ Выгрузка больше {limit_mb} МБ — лимита Telegram на файлы от бота. Разбейте ее: {hint}.")
+        if not rows_total:
+            return await bot.send_message(chat_id, "Нет данных для выгрузки.")
+        name = f"{opts['kind']}_{datetime.now(timezone.utc):%Y%m%d_%H%M}{suffix}"
+        await bot.send_document(chat_id, FSInputFile(path, filename=name), caption=f"📦 Строк: {rows_total}")
+    except Exception:
+        logging.exception("Export %s failed", opts['kind'])
+        await bot.send_message(chat_id, "❌ Не удалось сделать выгрузку.")
+    finally:
+        os.remove(path)
+
+@router.message(Command("export"))
+async def cmd_export(message: Message):
+    user = await get_user(message.from_user.id)
+    if not user or user['role'] != 'admin': return
+
+    try: opts = parse_export_args(message.text)
+    except ValueError: return await message.answer(EXPORT_USAGE, parse_mode="HTML")
+
+    # Выгрузка идет в фоне, чтобы не занимать воркер вебхука
+    busy = export_slots.locked()
+    start_background(run_export(message.chat.id, opts))
+    if busy: await message.answer("⏳ Сейчас идет другая выгрузка, ваша начнется сразу после нее.")
+    else: await message.answer("⏳ Готовлю выгрузку, пришлю файл, когда будет готово.")
 
 @router.message(F.text == "🛠 Закрыть баг")
 async def btn_fix_bug(message: Message, state: FSMContext):
@@ -396,23 +1744,272 @@ async def process_fix_bug(message: Message, state: FSMContext):
     await message.answer(f"🛠 Баг #{bug_id} отмечен как исправленный!", reply_markup=admin_kb)
     await state.clear()
 
+async def handler_metrics_middleware(handler, event, data):
+    name = data['handler'].callback.__name__
+    start = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        metrics.inc("bot_handler_errors_total", handler=name)
+        raise
+    finally:
+        metrics.observe("bot_handler_seconds", time.perf_counter() - start, handler=name)
+
+async def fsm_flush_worker():
+    """Пачками сохраняет изменения FSM, накопленные за FSM_FLUSH_INTERVAL"""
+    while True:
+        await asyncio.sleep(FSM_FLUSH_INTERVAL)
+        try:
+            await fsm_storage.flush()
+        except Exception:
+            logging.exception("FSM flush failed")
+
+async def user_cache_listener():
+    """Слушает изменения users на отдельном соединении и сбрасывает затронутые строки кэша"""
+    def on_notify(conn, pid, channel, payload):
+        if payload == '*': user_cache.clear()
+        else: user_cache.invalidate(*map(int, payload.split(',')))
+
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(DATABASE_URL)
+            lost = asyncio.Event()
+            conn.add_termination_listener(lambda c: lost.set())
+            await conn.add_listener(USER_CACHE_CHANNEL, on_notify)
+            # Изменения, случившиеся без подписки, уже не придут
+            user_cache.clear()
+            while not lost.is_set():
+                try:
+                    await asyncio.wait_for(lost.wait(), 60)
+                except asyncio.TimeoutError:
+                    # Простаивающее соединение может молча оборваться: проверяем его запросом
+                    await conn.execute("SELECT 1")
+            logging.warning("User cache listener connection closed, reconnecting")
+        except Exception:
+            logging.exception("User cache listener lost its connection")
+        finally:
+            if conn is not None: conn.terminate()
+        await asyncio.sleep(5)
+
+async def fsm_gc_worker():
+    """Удаляет брошенные черновики репортов и админских диалогов"""
+    while True:
+        try:
+            async with db_pool.acquire() as conn:
+                await conn.execute("DELETE FROM fsm_states WHERE updated_at < now() - make_interval(secs => $1)", float(FSM_TTL))
+        except Exception:
+            logging.exception("FSM cleanup failed")
+        await asyncio.sleep(FSM_GC_INTERVAL)
+
+def start_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+class Lifecycle:
+    """Готовность процесса для /ready и порядок корректной остановки"""
+    def __init__(self):
+        self.ready = False
+        self.stopping = False
+        self.drainers = [broadcast_queue.join]
+
+    def stop_accepting(self):
+        self.ready, self.stopping = False, True
+
+    async def shutdown(self, timeout: float, cancel_reserve: float = 2.0):
+        """Дожидается опустошения очередей, затем отменяет оставшиеся фоновые задачи — всё в пределах timeout.
+        На отмену оставляется cancel_reserve секунд из того же бюджета"""
+        self.stop_accepting()
+        deadline = time.monotonic() + timeout
+        drain_timeout = max(0.0, timeout - cancel_reserve)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(drain() for drain in self.drainers)), drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Queues were not drained in %ss, cancelling the rest", drain_timeout)
+
+        tasks = list(background_tasks)
+        for task in tasks: task.cancel()
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic()))
+            if pending: logging.warning("%s background tasks did not stop in time", len(pending))
+
+lifecycle = Lifecycle()
+
+class QueuedRequestHandler:
+    """Вебхук, который сразу отвечает Telegram и отдает апдейт воркерам.
+
+    Апдейты одного чата всегда попадают в одну и ту же очередь, поэтому обрабатываются по порядку,
+    а разные чаты — параллельно. Если очередь не освобождается за WEBHOOK_QUEUE_TIMEOUT,
+    отвечаем 503, и Telegram повторит доставку позже. Повторы уже принятых update_id отбрасываются.
+    """
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int, queue_size: int, put_timeout: float, dedup_size: int):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.put_timeout = put_timeout
+        self.queues = [asyncio.Queue(max(1, queue_size // workers)) for _ in range(workers)]
+        self.seen = deque(maxlen=dedup_size)
+        self.seen_ids = set()
+
+    def register(self, app: web.Application, path: str):
+        app.router.add_post(path, self.handle)
+        app.on_startup.append(self._start_workers)
+        lifecycle.drainers.append(self.drain)
+
+    async def drain(self):
+        await asyncio.gather(*(q.join() for q in self.queues))
+
+    async def _start_workers(self, app: web.Application):
+        for queue in self.queues:
+            start_background(self._worker(queue))
+
+    @staticmethod
+    def _shard_key(update: Update) -> int:
+        event = update.event
+        chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+        if chat: return chat.id
+        user = getattr(event, 'from_user', None)
+        return user.id if user else update.update_id
+
+    def _remember(self, update_id: int):
+        if len(self.seen) == self.seen.maxlen:
+            self.seen_ids.discard(self.seen[0])
+        self.seen.append(update_id)
+        self.seen_ids.add(update_id)
+
+    def _forget(self, update_id: int):
+        if update_id in self.seen_ids:
+            self.seen.remove(update_id)
+            self.seen_ids.discard(update_id)
+
+    def _report_depth(self):
+        metrics.set("bot_webhook_queue_size", sum(q.qsize() for q in self.queues))
+
+    async def handle(self, request: web.Request):
+        # Во время остановки апдейты не принимаем: Telegram повторит их уже новому инстансу
+        if lifecycle.stopping: return web.Response(status=503)
+        update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        if update.update_id in self.seen_ids:
+            metrics.inc("bot_webhook_duplicates_total")
+            return web.Response()
+
+        # Запоминаем до ожидания места в очереди, иначе повтор, пришедший за это время, тоже пройдет проверку
+        self._remember(update.update_id)
+        queue = self.queues[self._shard_key(update) % len(self.queues)]
+        try:
+            await asyncio.wait_for(queue.put(update), self.put_timeout)
+        except asyncio.TimeoutError:
+            self._forget(update.update_id)
+            metrics.inc("bot_webhook_rejected_total")
+            return web.Response(status=503)
+        self._report_depth()
+        return web.Response()
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+            except Exception:
+                logging.exception("Failed to process update %s", update.update_id)
+            finally:
+                queue.task_done()
+                self._report_depth()
+
 async def on_startup(bot: Bot):
     await init_db()
+    await warm_up_pool()
+    for bc_id in await pending_broadcasts():
+        broadcast_queue.put_nowait(bc_id)
+    start_background(broadcast_worker())
+    start_background(fsm_gc_worker())
+    start_background(fsm_flush_worker())
+    start_background(user_cache_listener())
     if BASE_WEBHOOK_URL:
-        await bot.set_webhook(f"{BASE_WEBHOOK_URL}{WEBHOOK_PATH}", drop_pending_updates=True)
+        # При раскатке новый инстанс не переустанавливает вебхук и не теряет накопившиеся апдейты
+        url = f"{BASE_WEBHOOK_URL}{WEBHOOK_PATH}"
+        if (await bot.get_webhook_info()).url != url:
+            await bot.set_webhook(url)
+    lifecycle.ready = True
 
-def main():
+async def on_shutdown(bot: Bot):
+    await lifecycle.shutdown(SHUTDOWN_TIMEOUT)
+    if db_pool:
+        async def close_db():
+            # Несколько попыток: ключи, слитые после конфликта версий, пишутся следующим flush
+            for _ in range(3):
+                if not fsm_storage.dirty: break
+                try: await fsm_storage.flush()
+                except Exception: logging.exception("Final FSM flush failed")
+            await db_pool.close()
+        try:
+            await asyncio.wait_for(close_db(), SHUTDOWN_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning("Database was not closed in %ss, %s FSM keys unsaved", SHUTDOWN_CLOSE_TIMEOUT, len(fsm_storage.dirty))
+    await bot.session.close()
+
+def create_app() -> web.Application:
     dp.include_router(router)
+    dp.update.outer_middleware(AlbumMiddleware(ALBUM_DEBOUNCE))
+    if THROTTLE_ENABLED:
+        throttling = ThrottlingMiddleware(THROTTLE_RULES, THROTTLE_DEFAULT)
+        router.message.middleware(throttling)
+        router.callback_query.middleware(throttling)
+    router.message.middleware(handler_metrics_middleware)
+    router.callback_query.middleware(handler_metrics_middleware)
     dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
 
     app = web.Application()
     app.router.add_get('/', ping_handler)
-    
-    webhook_requests_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
-    webhook_requests_handler.register(app, path=WEBHOOK_PATH)
+    app.router.add_get('/ready', ready_handler)
+    app.router.add_get('/metrics', metrics_handler)
+    # Сначала хуки диспетчера: SimpleRequestHandler закрывает сессию бота в своем on_shutdown,
+    # а on_shutdown должен успеть дослать сообщения из очередей
     setup_application(app, dp, bot=bot)
-    
-    web.run_app(app, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
+
+    if WEBHOOK_WORKERS > 0:
+        webhook_requests_handler = QueuedRequestHandler(
+            dp, bot, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_QUEUE_TIMEOUT, WEBHOOK_DEDUP_SIZE
+        )
+    else:
+        webhook_requests_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
+    webhook_requests_handler.register(app, path=WEBHOOK_PATH)
+    return app
+
+async def serve():
+    """Запускает веб-сервер и корректно останавливает его по SIGTERM/SIGINT.
+
+    aiohttp закрывает сокет раньше, чем вызывает on_shutdown, поэтому готовность снимается здесь:
+    пока идет SHUTDOWN_GRACE, сервер еще слушает порт, /ready отвечает 503, а вебхук — 503,
+    и Telegram повторит апдейты другому инстансу. Затем runner закрывает сокет и зовет on_shutdown.
+
+    На Windows add_signal_handler не поддерживается: там Ctrl+C отменяет serve через asyncio.run,
+    и остановка идет сразу, без паузы SHUTDOWN_GRACE.
+    """
+    runner = web.AppRunner(create_app(), shutdown_timeout=SERVER_SHUTDOWN_TIMEOUT)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEB_SERVER_HOST, WEB_SERVER_PORT).start()
+        logging.info("Listening on %s:%s", WEB_SERVER_HOST, WEB_SERVER_PORT)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        try:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            logging.info("Signal handlers are not supported here, stopping on KeyboardInterrupt only")
+        await stop.wait()
+        logging.info("Stopping: not ready, waiting %ss before closing the listener", SHUTDOWN_GRACE)
+        lifecycle.stop_accepting()
+        await asyncio.sleep(SHUTDOWN_GRACE)
+    finally:
+        lifecycle.stop_accepting()
+        await runner.cleanup()
+
+def main():
+    asyncio.run(serve())
 
 if __name__ == "__main__":
     main()